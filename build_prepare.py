@@ -1,8 +1,19 @@
+import contextlib
+import glob
+import hmac
+import json
 import os
+import re
+import secrets
 import shutil
+import socket
+import socketserver
 import stat
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count
 
 
@@ -385,7 +396,22 @@ def find_msvs():
     return vs
 
 
-def copy_win32mak():
+def find_toolchain():
+    """Return the Visual Studio to use and whether it is VS 2015."""
+    if dry_run:
+        msvs = {
+            "header": ['call "vcvarsall.bat" {vcvars_arch}'],
+            "nmake": "nmake.exe",
+            "vs_dir": "(dry run)",
+        }
+        return msvs, True
+    msvs = find_msvs2015()
+    if msvs is not None:
+        return msvs, True
+    return find_msvs(), False
+
+
+def find_win32mak():
     import winreg
     try:
         key = winreg.OpenKeyEx(
@@ -411,38 +437,121 @@ def copy_win32mak():
                 if vt == winreg.REG_SZ:
                     sdk_include_dir = os.path.join(sdk_dir, "Include")
                     tgts = ["Win32.Mak", "NtWin32.Mak"]
-                    ops = [(os.path.join(sdk_include_dir, t), os.path.join(aux_dir, t)) for t in tgts]
-                    if all(os.path.isfile(a) for a, b in ops):
-                        for a, b in ops:
-                            shutil.copyfile(a, b)
-                        return v
+                    if all(os.path.isfile(os.path.join(sdk_include_dir, t)) for t in tgts):
+                        return [v, sdk_include_dir]
 
 
-def extract_dep(url, filename, dir=None):
+def copy_win32mak(sdk):
+    if sdk is None:
+        return None
+    v, sdk_include_dir = sdk
+    for t in ["Win32.Mak", "NtWin32.Mak"]:
+        shutil.copyfile(os.path.join(sdk_include_dir, t), os.path.join(aux_dir, t))
+    return v
+
+
+def fetch_dep(url, filename):
     import urllib.request
-    import tarfile
-    import zipfile
 
     file = os.path.join(depends_dir, filename)
-    if not os.path.exists(file):
-        ex = None
-        for i in range(3):
+    if os.path.exists(file):
+        return file
+    if "PYPY_EXT_SERVER" in os.environ:
+        # running as a --serve job, let the server download into its cache
+        send_request(int(os.environ["PYPY_EXT_SERVER"]), {"fetch": url, "filename": filename})
+        return file
+
+    with cache_lock(file):
+        if os.path.exists(file):
+            # downloaded by another run while we were waiting
+            return file
+        part = "%s.%d.part" % (file, os.getpid())
+        try:
+            ex = None
+            for i in range(3):
+                try:
+                    print("Fetching %s (attempt %d)..." % (url, i + 1))
+                    content = urllib.request.urlopen(url).read()
+                    break
+                except urllib.error.URLError as e:
+                    ex = e
+            else:
+                raise RuntimeError(ex)
+            # concurrent runs may share the cache, never expose partial files
+            with open(part, "wb") as f:
+                f.write(content)
+            try:
+                os.replace(part, file)
+            except OSError:
+                # on Windows, fails if the file appeared and is being extracted
+                if not os.path.exists(file):
+                    raise
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+    return file
+
+
+@contextlib.contextmanager
+def cache_lock(file):
+    """Lock `file`.lock, shared by every run using the same cache directory.
+
+    The OS drops the lock when its holder exits, even if it was killed.
+    """
+    with open(file + ".lock", "a+b") as f:
+        waiting = False
+        while True:
             try:
-                print("Fetching %s (attempt %d)..." % (url, i + 1))
-                content = urllib.request.urlopen(url).read()
-                with open(file, "wb") as f:
-                    f.write(content)
+                if os.name == "nt":
+                    import msvcrt
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    import fcntl
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
                 break
-            except urllib.error.URLError as e:
-                ex = e
-        else:
-            raise RuntimeError(ex)
+            except OSError:
+                if not waiting:
+                    print("Waiting for lock on " + file)
+                    waiting = True
+                time.sleep(1)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def io_slot(filename):
+    """Wait for the --serve process to allow extracting `filename`."""
+    if "PYPY_EXT_SERVER" not in os.environ:
+        yield
+        return
+    # the slot is held until the connection is closed
+    with connect(int(os.environ["PYPY_EXT_SERVER"]), {"extract": filename}) as f:
+        read_reply(f)
+        yield
+
+
+def extract_dep(url, filename, dir=None):
+    if dry_run:
+        print("Would fetch %s and extract %s" % (url, filename))
+        return
+    file = fetch_dep(url, filename)
+
+    with io_slot(filename):
+        print("Extracting " + filename)
+        unpack(file, filename, os.path.join(build_dir, dir) if dir else build_dir)
+
+
+def unpack(file, filename, dir):
+    import tarfile
+    import zipfile
 
-    print("Extracting " + filename)
-    if dir:
-        dir = os.path.join(build_dir, dir)
-    else:
-        dir = build_dir
     if filename.endswith(".zip"):
         with zipfile.ZipFile(file) as zf:
             zf.extractall(dir)
@@ -475,9 +584,12 @@ def extract_dep(url, filename, dir=None):
 def write_script(name, lines):
     name = os.path.join(build_dir, name)
     lines = [line.format(**prefs) for line in lines]
-    print("Writing " + name)
-    with open(name, "w") as f:
-        f.write("\n".join(lines))
+    if dry_run:
+        print("Would write " + name)
+    else:
+        print("Writing " + name)
+        with open(name, "w") as f:
+            f.write("\n".join(lines))
     if verbose:
         for line in lines:
             print("    " + line)
@@ -497,6 +609,21 @@ def get_footer(dep):
     return lines
 
 
+def get_steps(name):
+    dep = deps[name]
+    dir = dep["dir"]
+    banner = "Building {name} ({dir})".format(**locals())
+    return [
+        "@echo " + ("=" * 70),
+        "@echo ==== {:<60} ====".format(banner),
+        "@echo " + ("=" * 70),
+        "cd /D %s" % os.path.join(build_dir, dir),
+        *prefs["header"],
+        *dep.get("build", []),
+        *get_footer(dep),
+    ]
+
+
 def build_dep(name):
     dep = deps[name]
     dir = dep["dir"]
@@ -505,8 +632,10 @@ def build_dep(name):
     extract_dep(dep["url"], dep["filename"], dep["dir"] if dep.get("dir-create", False) else None)
 
     for patch_file, patch_list in dep.get("patch", {}).items():
-        if verbose:
+        if verbose or dry_run:
             print("Patching " + patch_file)
+        if dry_run:
+            continue
         patch_file = os.path.join(build_dir, dir, patch_file.format(**prefs))
         with open(patch_file, "r") as f:
             text = f.read()
@@ -515,21 +644,131 @@ def build_dep(name):
         with open(patch_file, "w") as f:
             f.write(text)
 
-    banner = "Building {name} ({dir})".format(**locals())
-    lines = [
-        "@echo " + ("=" * 70),
-        "@echo ==== {:<60} ====".format(banner),
-        "@echo " + ("=" * 70),
-        "cd /D %s" % os.path.join(build_dir, dir),
-        *prefs["header"],
-        *dep.get("build", []),
-        *get_footer(dep),
-    ]
-
-    write_script(file, lines)
+    write_script(file, get_steps(name))
     return file
 
 
+class Executor:
+    """Run the steps of a build script in-process instead of through cmd.exe.
+
+    Only vcvarsall (once per distinct environment) and nmake spawn processes,
+    cd/set/path/copy/xcopy are done directly in Python.
+    """
+
+    def __init__(self):
+        # environment captured after each vcvarsall call, keyed by its input
+        self.vcvars_envs = {}
+        self.timings = []
+
+    def run(self, name, lines):
+        # every build_<name>.cmd runs in a fresh cmd.exe, start from scratch
+        self.env = {k.upper(): v for k, v in os.environ.items()}
+        self.cwd = build_dir
+        start = time.perf_counter()
+        try:
+            for line in lines:
+                line = line.format(**prefs)
+                if verbose:
+                    print("    " + line)
+                self.step(line)
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def step(self, line):
+        args = re.findall(r'"([^"]*)"', line)
+        if line.startswith("@echo "):
+            if line != "@echo on":
+                print(line[6:])
+        elif line.startswith("@if errorlevel"):
+            # failing steps raise immediately
+            pass
+        elif line.startswith("cd /D "):
+            self.cwd = os.path.join(self.cwd, line[6:])
+        elif line.startswith("set "):
+            name, value = line[4:].split("=", 1)
+            self.env[name.upper()] = self.expand(value)
+        elif line.startswith("path "):
+            self.env["PATH"] = self.expand(line[5:])
+        elif line.startswith("call "):
+            key = (line, tuple(sorted(self.env.items())))
+            if key not in self.vcvars_envs:
+                self.vcvars_envs[key] = self.capture_env(line)
+            self.env = dict(self.vcvars_envs[key])
+        elif line.startswith("copy "):
+            self.copy(*args)
+        elif line.startswith("xcopy "):
+            self.xcopy(*args)
+        elif line.startswith(prefs["nmake"] + " "):
+            self.nmake(line[len(prefs["nmake"]):])
+        else:
+            raise ValueError("Unsupported build step: " + line)
+
+    def expand(self, value):
+        return re.sub(
+            r"%(\w+)%", lambda m: self.env.get(m.group(1).upper(), m.group(0)), value
+        )
+
+    def capture_env(self, line):
+        print("Running " + line)
+        proc = subprocess.run(
+            'cmd.exe /s /c "{} >nul && set"'.format(line),
+            cwd=self.cwd,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if proc.returncode != 0:
+            print(proc.stderr.decode(encoding="mbcs", errors="replace"), end="")
+            raise subprocess.CalledProcessError(proc.returncode, line)
+        env = {}
+        for entry in proc.stdout.decode(encoding="mbcs", errors="replace").splitlines():
+            key, _, value = entry.partition("=")
+            if key and value:
+                env[key.upper()] = value
+        return env
+
+    def copy(self, src, tgt):
+        files = glob.glob(os.path.join(self.cwd, src))
+        if not files:
+            raise RuntimeError("File not found: " + src)
+        for file in files:
+            shutil.copy(file, os.path.join(self.cwd, tgt))
+
+    def xcopy(self, src, tgt):
+        src = os.path.join(self.cwd, src)
+        tgt = os.path.join(self.cwd, tgt)
+        if not os.path.isdir(src):
+            raise RuntimeError("File not found: " + src)
+        for root, dirs, files in os.walk(src):
+            out = os.path.join(tgt, os.path.relpath(root, src))
+            os.makedirs(out, exist_ok=True)
+            for file in files:
+                shutil.copy(os.path.join(root, file), out)
+
+    def nmake(self, params):
+        exe = shutil.which(prefs["nmake"], path=self.env.get("PATH"))
+        if exe is None:
+            raise RuntimeError("nmake not found in PATH")
+        subprocess.run('"{}"{}'.format(exe, params), cwd=self.cwd, env=self.env, check=True)
+
+
+class DryRunExecutor(Executor):
+    """Print what Executor would do without touching files or spawning processes."""
+
+    def capture_env(self, line):
+        print("Would run " + line)
+        return dict(self.env)
+
+    def copy(self, src, tgt):
+        print("Would copy %s to %s" % (os.path.join(self.cwd, src), os.path.join(self.cwd, tgt)))
+
+    def xcopy(self, src, tgt):
+        print("Would copy tree %s to %s" % (os.path.join(self.cwd, src), os.path.join(self.cwd, tgt)))
+
+    def nmake(self, params):
+        print("Would run %s%s in %s" % (prefs["nmake"], params, self.cwd))
+
+
 def build_all():
     lines = ["@echo on"]
     enabled = []
@@ -549,6 +788,194 @@ def build_all():
     print("Skipped disabled targets: " + ", ".join(skipped))
 
 
+def run_all(executor):
+    try:
+        for dep_name in deps:
+            if dep_name in disabled:
+                continue
+            try:
+                executor.run(dep_name, get_steps(dep_name))
+            except Exception as e:
+                raise RuntimeError("Build failed: " + dep_name) from e
+        print("All PyPy dependencies built successfully!")
+    finally:
+        print()
+        for dep_name, elapsed in executor.timings:
+            print("{:<20} {:8.2f}s".format(dep_name, elapsed))
+        print("{:<20} {:8.2f}s".format("total", sum(t for n, t in executor.timings)))
+
+
+def get_token(port):
+    token_file = os.path.join(depends_dir, "server-%d.token" % port)
+    try:
+        with open(token_file) as f:
+            return f.read()
+    except FileNotFoundError:
+        raise RuntimeError(
+            "Server token %s not found. Is a server running on port %d with the same --depends?"
+            % (token_file, port)
+        ) from None
+
+
+def connect(port, request):
+    request = dict(request, token=get_token(port))
+    try:
+        sock = socket.create_connection(("127.0.0.1", port))
+    except ConnectionRefusedError:
+        raise RuntimeError("No server listening on port %d" % port) from None
+    f = sock.makefile("rwb")
+    # the file keeps the connection open
+    sock.close()
+    f.write(json.dumps(request).encode() + b"\n")
+    f.flush()
+    return f
+
+
+def read_reply(f):
+    line = f.readline()
+    if not line:
+        raise RuntimeError("Connection to server closed")
+    reply = json.loads(line)
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply
+
+
+def send_request(port, request):
+    with connect(port, request) as f:
+        return read_reply(f)
+
+
+def serve(port, jobs, io, root, toolchain):
+    """Prepare dependency sets submitted with --submit, sharing one cache.
+
+    Each job runs this script in a child process with at most `jobs` running
+    at once, building into a directory below `root`. Children reuse the Visual
+    Studio and Windows SDK found here and download through the server, so every
+    archive is fetched only once. Downloads and extractions share `io` slots.
+    Clients authenticate with a token stored in the cache directory.
+    """
+    job_pool = ThreadPoolExecutor(jobs)
+    fetch_pool = ThreadPoolExecutor(io)
+    io_slots = threading.BoundedSemaphore(io)
+    fetches = {}
+    active_dirs = set()
+    lock = threading.Lock()
+    root = os.path.normcase(os.path.realpath(root))
+    env = dict(os.environ, PYPY_EXT_SERVER=str(port), PYPY_EXT_MSVS=json.dumps(toolchain))
+
+    token = secrets.token_hex(32)
+    token_file = os.path.join(depends_dir, "server-%d.token" % port)
+
+    def is_within(parent, path):
+        return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+    def download(url, filename):
+        with io_slots:
+            fetch_dep(url, filename)
+
+    def fetch(url, filename):
+        with lock:
+            future = fetches.get(filename)
+            if future is None or (future.done() and future.exception()):
+                future = fetches[filename] = fetch_pool.submit(download, url, filename)
+        future.result()
+        return {}
+
+    def run_job(args, dir, submitted, send):
+        started = time.perf_counter()
+        print("Started job for " + dir)
+        send({"output": "Started after waiting %.2fs\n" % (started - submitted)})
+        proc = subprocess.Popen(
+            [sys.executable, os.path.realpath(__file__), *args,
+             "--dir=" + dir, "--depends=" + depends_dir],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        with proc:
+            for line in proc.stdout:
+                send({"output": line.decode(errors="replace")})
+        return {
+            "returncode": proc.returncode,
+            "queued": started - submitted,
+            "elapsed": time.perf_counter() - started,
+        }
+
+    def submit(args, dir, send):
+        if any(arg.startswith(("--serve=", "--submit=")) for arg in args):
+            raise RuntimeError("Jobs cannot start or submit to servers")
+        if dry_run and "--dry-run" not in args:
+            raise RuntimeError("Server was started with --dry-run, jobs must use --dry-run too")
+        # the server chooses the output and cache directories, not the job
+        args = [arg for arg in args if not arg.startswith(("--dir=", "--depends="))]
+        dir = os.path.normcase(os.path.realpath(dir))
+        if dir == root or not is_within(root, dir):
+            raise RuntimeError("Output directory must be below " + root)
+        with lock:
+            for active in active_dirs:
+                if is_within(active, dir) or is_within(dir, active):
+                    raise RuntimeError("Already preparing " + active)
+            active_dirs.add(dir)
+        try:
+            print("Queued job for " + dir)
+            reply = job_pool.submit(run_job, args, dir, time.perf_counter(), send).result()
+        finally:
+            with lock:
+                active_dirs.remove(dir)
+        print("Finished job for %s with exit code %d (queued %.2fs, ran %.2fs)"
+              % (dir, reply["returncode"], reply["queued"], reply["elapsed"]))
+        return reply
+
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, reply):
+            try:
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+            except OSError:
+                # client went away, the job keeps running
+                pass
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                self.send({"error": "Invalid request"})
+                return
+            if not hmac.compare_digest(str(request.get("token")).encode(), token.encode()):
+                self.send({"error": "Invalid token"})
+                return
+            try:
+                if "fetch" in request:
+                    reply = fetch(request["fetch"], request["filename"])
+                elif "extract" in request:
+                    with io_slots:
+                        self.send({})
+                        # held until the client closes the connection
+                        self.rfile.read()
+                    return
+                else:
+                    reply = submit(request["args"], request["dir"], self.send)
+            except Exception as e:
+                reply = {"error": str(e)}
+            self.send(reply)
+
+    # bind first, a second server on the same port must not replace our token
+    with socketserver.ThreadingTCPServer(("127.0.0.1", port), Handler) as server:
+        server.daemon_threads = True
+        # only readable by our user on POSIX, on Windows the cache directory ACL applies
+        fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w") as f:
+            f.write(token)
+        try:
+            print("Serving on port %d, running up to %d jobs and %d downloads or "
+                  "extractions at once below %s" % (port, jobs, io, root))
+            server.serve_forever()
+        finally:
+            os.remove(token_file)
+
+
 if __name__ == "__main__":
     if sys.version_info < (3, 6, 0):
         raise RuntimeError("This script requires Python 3.6+")
@@ -562,6 +989,13 @@ if __name__ == "__main__":
     architecture = "x64"
     build_dir = os.path.join(winbuild_dir, "build")
     force_tk = False
+    execute = False
+    dry_run = False
+    serve_port = None
+    submit_port = None
+    jobs = 2
+    io = 2
+    root = winbuild_dir
     for arg in sys.argv[1:]:
         if arg == "-v":
             verbose = True
@@ -578,28 +1012,68 @@ if __name__ == "__main__":
             force_tk = True
         elif arg == "--no-boehm":
             disabled.append("boehm")
+        elif arg == "--build":
+            execute = True
+        elif arg == "--dry-run":
+            execute = True
+            dry_run = True
+        elif arg.startswith("--serve="):
+            serve_port = int(arg[8:])
+        elif arg.startswith("--submit="):
+            submit_port = int(arg[9:])
+        elif arg.startswith("--jobs="):
+            jobs = int(arg[7:])
+        elif arg.startswith("--io="):
+            io = int(arg[5:])
+        elif arg.startswith("--root="):
+            root = os.path.abspath(arg[7:])
         else:
             raise ValueError("Unknown parameter: " + arg)
 
+    if submit_port is not None:
+        # --depends locates the server token, the server uses its own cache
+        args = [
+            arg for arg in sys.argv[1:]
+            if not arg.startswith(("--submit=", "--dir=", "--depends="))
+        ]
+        with connect(submit_port, {"args": args, "dir": build_dir}) as f:
+            while True:
+                reply = read_reply(f)
+                if "output" not in reply:
+                    break
+                print(reply["output"], end="", flush=True)
+        print("Job queued for %.2fs, ran for %.2fs" % (reply["queued"], reply["elapsed"]))
+        sys.exit(reply["returncode"])
+
     # dependency cache directory
     os.makedirs(depends_dir, exist_ok=True)
     print("Caching dependencies in:", depends_dir)
 
-    arch_prefs = architectures[architecture]
-    print("Target Architecture:", architecture)
-
-    msvs = find_msvs2015()
-    if msvs is None:
-        msvs = find_msvs()
-        if not force_tk:
-            # see warning below
-            disabled.extend(["tcl", "tk"])
+    if "PYPY_EXT_MSVS" in os.environ:
+        # discovered once by the --serve process
+        msvs, vs2015, win32mak = json.loads(os.environ["PYPY_EXT_MSVS"])
+    else:
+        msvs, vs2015 = find_toolchain()
+        win32mak = None
     if msvs is None:
         raise RuntimeError(
             "Visual Studio not found. Please install Visual Studio 2015 or newer."
         )
     print("Found Visual Studio at:", msvs["vs_dir"])
 
+    if serve_port is not None:
+        if not dry_run:
+            win32mak = find_win32mak()
+        serve(serve_port, jobs, io, root, [msvs, vs2015, win32mak])
+        sys.exit()
+
+    if not vs2015 and not force_tk:
+        # see warning below
+        disabled.extend(["tcl", "tk"])
+
+    arch_prefs = architectures[architecture]
+    print("Target Architecture:", architecture)
+
     print("Using output directory:", build_dir)
 
     # build directory for *.h files
@@ -620,10 +1094,13 @@ if __name__ == "__main__":
         else:
             raise
 
-    if os.path.isdir(build_dir):
-        shutil.rmtree(build_dir, onerror=rmtree_onerror)
-    for path in [build_dir, inc_dir, lib_dir, bin_dir, aux_dir, tcltk_dir]:
-        os.makedirs(path)
+    if dry_run:
+        print("Would recreate output directory:", build_dir)
+    else:
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir, onerror=rmtree_onerror)
+        for path in [build_dir, inc_dir, lib_dir, bin_dir, aux_dir, tcltk_dir]:
+            os.makedirs(path)
 
     prefs = {
         # Target architecture
@@ -658,9 +1135,11 @@ if __name__ == "__main__":
 
     build_all()
 
-    if "boehm" not in disabled:
+    if "boehm" not in disabled and not dry_run:
         print()
-        xp_sdk = copy_win32mak()
+        if "PYPY_EXT_MSVS" not in os.environ:
+            win32mak = find_win32mak()
+        xp_sdk = copy_win32mak(win32mak)
         if xp_sdk is None:
             print("!!! ntwin32.mak or win32.mak not found, required by Boehm GC.")
             print("!!! Install Windows XP support in VS2015 or older and rerun %s, "
@@ -668,6 +1147,8 @@ if __name__ == "__main__":
                   % (os.path.basename(__file__), aux_dir))
             print("!!! You can skip Boehm GC compilation by running '%s --no-boehm'."
                   % os.path.basename(__file__))
+            if execute:
+                raise RuntimeError("Cannot build Boehm GC without ntwin32.mak and win32.mak")
         else:
             print("Copied ntwin32.mak and win32.mak from Windows SDK %s" % xp_sdk)
 
@@ -680,3 +1161,7 @@ if __name__ == "__main__":
               "You may have to specify the target SDK version in the function 'find_msvs()' "
               "by replacing 'call \"{}\" {{vcvars_arch}}' with 'call \"{}\" {{vcvars_arch}} <sdk_version>'."
               % os.path.basename(__file__))
+
+    if execute:
+        print()
+        run_all(DryRunExecutor() if dry_run else Executor())